@@ -1,8 +1,12 @@
 import streamlit as st
 import pandas as pd
-from supabase import create_client, Client
-from datetime import datetime, date
+from supabase import create_client, Client, ClientOptions
+import httpx
+from datetime import datetime, date, timedelta
 import time
+import random
+import threading
+import logging
 import io
 import base64
 from PIL import Image, ImageOps
@@ -12,6 +16,8 @@ from streamlit_cropper import st_cropper
 # 1. 設定與工具
 # ==========================================
 
+logger = logging.getLogger("pet_feed_db")
+
 try:
     icon_image = Image.open("logo.png")
 except:
@@ -40,6 +46,16 @@ CATEGORY_REVERSE = {v: k for k, v in CATEGORY_MAP.items()}
 FOOD_CATEGORIES_CODE = ["wet_food", "dry_food", "snack", "other"]
 HEALTH_OPTIONS = ["健康", "腎貓", "胰貓", "糖貓", "其它"]
 
+# [新增] 健康標籤營養警示：每公斤體重每日上限 (熱量 kcal、脂肪 g、磷 mg)，可在 secrets.toml 的 [alerts] 區塊覆寫
+ALERT_RULES = {
+    "腎貓": {"phos": 80.0},
+    "胰貓": {"fat": 1.5},
+    "糖貓": {"calories": 55.0, "fat": 2.5},
+}
+ALERT_WINDOWS = [1, 3, 7]
+# (名稱, 顯示單位, diet_logs 數值換算倍率)；diet_logs.phos = phos_pct × 重量/100，單位為 g
+ALERT_NUTRIENTS = {"calories": ("熱量", "kcal", 1), "fat": ("脂肪", "g", 1), "phos": ("磷", "mg", 1000)}
+
 if 'expand_edit' not in st.session_state: st.session_state.expand_edit = False
 # [新增] 用戶 ID 狀態
 if 'user_id' not in st.session_state: st.session_state.user_id = None
@@ -47,18 +63,168 @@ if 'user_id' not in st.session_state: st.session_state.user_id = None
 # ==========================================
 # 2. 資料庫連線
 # ==========================================
+# 連線參數預設值，可在 secrets.toml 的 [http] 區塊覆寫
+HTTP_DEFAULTS = {
+    "connect_timeout": 5.0,
+    "read_timeout": 15.0,
+    "write_timeout": 15.0,
+    "pool_timeout": 5.0,
+    "max_connections": 20,
+    "max_keepalive": 10,
+    "keepalive_expiry": 30.0,
+    "http2": True,
+    "max_retries": 2,
+    "backoff_base": 0.3,
+    "backoff_max": 3.0,
+    "breaker_threshold": 5,
+    "breaker_cooldown": 30.0,
+}
+
+def get_http_config():
+    cfg = dict(HTTP_DEFAULTS)
+    try: cfg.update(st.secrets.get("http", {}))
+    except: pass
+    return cfg
+
+HTTP_CONFIG = get_http_config()
+
+def build_http_client(cfg):
+    # 共用的 keep-alive 連線池 (所有 session 執行緒共用)
+    return httpx.Client(
+        http2=bool(cfg["http2"]),
+        timeout=httpx.Timeout(
+            connect=cfg["connect_timeout"], read=cfg["read_timeout"],
+            write=cfg["write_timeout"], pool=cfg["pool_timeout"]
+        ),
+        limits=httpx.Limits(
+            max_connections=int(cfg["max_connections"]),
+            max_keepalive_connections=int(cfg["max_keepalive"]),
+            keepalive_expiry=cfg["keepalive_expiry"]
+        ),
+    )
+
+@st.cache_resource
+def init_http_client():
+    try:
+        return build_http_client(HTTP_CONFIG)
+    except ImportError:
+        # 未安裝 h2 時退回 HTTP/1.1
+        return build_http_client({**HTTP_CONFIG, "http2": False})
+
 @st.cache_resource
 def init_supabase() -> Client:
     try:
         url = st.secrets["supabase"]["url"]
         key = st.secrets["supabase"]["key"]
-        return create_client(url, key)
+        try:
+            options = ClientOptions(httpx_client=init_http_client())
+        except TypeError:
+            # 舊版 supabase 不支援注入 httpx client，至少套用逾時設定
+            options = ClientOptions(postgrest_client_timeout=HTTP_CONFIG["read_timeout"])
+        return create_client(url, key, options=options)
     except Exception as e:
         st.error(f"資料庫連線設定錯誤: {e}")
         return None
 
 supabase = init_supabase()
 
+# ------------------------------------------
+# 重試 / 斷路器 (跨 session 共用狀態)
+# ------------------------------------------
+@st.cache_resource
+def init_http_state():
+    return {
+        "lock": threading.Lock(),
+        "failures": 0,          # 連續失敗次數
+        "open_until": 0.0,      # 斷路器開啟到何時 (time.monotonic)
+        "requests": 0,
+        "retries": 0,
+        "errors": 0,
+        "rejected": 0,
+        "in_flight": 0,
+    }
+
+http_state = init_http_state()
+
+class CircuitOpenError(Exception):
+    pass
+
+def _http_status(e):
+    # 只認 HTTP 狀態碼；postgrest APIError.code 通常是 Postgres SQLSTATE (如 23505)，不可混用
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if isinstance(status, int): return status
+    code = str(getattr(e, 'code', '') or '')
+    if len(code) == 3 and code.isdigit(): return int(code)
+    return None
+
+def is_transient_error(e):
+    if isinstance(e, (httpx.TransportError, httpx.TimeoutException)): return True
+    status = _http_status(e)
+    return status is not None and 500 <= status <= 599
+
+def _record_result(ok, transient=False):
+    with http_state["lock"]:
+        if ok:
+            http_state["failures"] = 0
+            return
+        http_state["errors"] += 1
+        # 約束 / 權限等用戶端錯誤不計入共用的斷路器
+        if not transient: return
+        http_state["failures"] += 1
+        if http_state["failures"] >= HTTP_CONFIG["breaker_threshold"]:
+            http_state["open_until"] = time.monotonic() + HTTP_CONFIG["breaker_cooldown"]
+            http_state["failures"] = 0
+
+def run_query(query, idempotent=True):
+    """執行 Supabase 查詢；讀取類 (idempotent) 遇到暫時性錯誤會以 jitter backoff 重試。"""
+    with http_state["lock"]:
+        if time.monotonic() < http_state["open_until"]:
+            http_state["rejected"] += 1
+            raise CircuitOpenError("資料庫暫時無法連線，請稍後再試")
+        http_state["requests"] += 1
+        http_state["in_flight"] += 1
+
+    max_retries = int(HTTP_CONFIG["max_retries"]) if idempotent else 0
+    try:
+        attempt = 0
+        while True:
+            try:
+                res = query.execute()
+                _record_result(True)
+                return res
+            except Exception as e:
+                transient = is_transient_error(e)
+                _record_result(False, transient)
+                if not transient:
+                    raise
+                if attempt >= max_retries:
+                    raise
+                # full jitter: 0 ~ min(上限, base * 2^n)
+                delay = min(HTTP_CONFIG["backoff_max"], HTTP_CONFIG["backoff_base"] * (2 ** attempt))
+                time.sleep(random.uniform(0, delay))
+                attempt += 1
+                with http_state["lock"]:
+                    http_state["retries"] += 1
+    finally:
+        with http_state["lock"]:
+            http_state["in_flight"] -= 1
+
+def get_http_stats():
+    with http_state["lock"]:
+        stats = {k: v for k, v in http_state.items() if k != "lock"}
+    stats["breaker_open"] = time.monotonic() < stats.pop("open_until")
+    stats["max_connections"] = int(HTTP_CONFIG["max_connections"])
+    # 連線池使用狀況 (httpcore 內部結構，取不到時略過)
+    try:
+        conns = init_http_client()._transport._pool.connections
+        stats["pool_total"] = len(conns)
+        stats["pool_idle"] = sum(1 for c in conns if c.is_idle())
+        stats["pool_active"] = stats["pool_total"] - stats["pool_idle"]
+    except Exception:
+        pass
+    return stats
+
 # ==========================================
 # 3. 資料操作函式
 # ==========================================
@@ -80,12 +246,12 @@ def save_pet(data_dict, pet_id=None):
     try:
         st.cache_data.clear()
         if pet_id:
-            supabase.table('pets').update(data_dict).eq('id', pet_id).execute()
+            run_query(supabase.table('pets').update(data_dict).eq('id', pet_id), idempotent=False)
             return pet_id
         else:
             if 'image_data' in data_dict and data_dict['image_data'] is None:
                 del data_dict['image_data']
-            res = supabase.table('pets').insert(data_dict).select().execute()
+            res = run_query(supabase.table('pets').insert(data_dict).select(), idempotent=False)
             if res.data: return res.data[0]['id']
             return None
     except Exception as e:
@@ -96,33 +262,39 @@ def fetch_pets():
     try:
         user = st.session_state.user_id
         # [修改] 只抓取目前登入使用者的寵物
-        response = supabase.table('pets').select("*")\
+        response = run_query(supabase.table('pets').select("*")\
             .neq('is_deleted', True)\
             .eq('user_id', user)\
-            .order('created_at').execute()
+            .order('created_at'))
         return pd.DataFrame(response.data)
     except Exception as e:
         return pd.DataFrame()      
 
 def check_pet_has_data(pet_id):
     try:
-        res_menu = supabase.table('pet_food_relations').select("id", count='exact').eq('pet_id', pet_id).execute() 
+        res_menu = run_query(supabase.table('pet_food_relations').select("id", count='exact').eq('pet_id', pet_id))
         count_menu = res_menu.count if res_menu.count is not None else len(res_menu.data)
-        res_logs = supabase.table('diet_logs').select("id", count='exact').eq('pet_id', pet_id).execute()
+        res_logs = run_query(supabase.table('diet_logs').select("id", count='exact').eq('pet_id', pet_id))
         count_logs = res_logs.count if res_logs.count is not None else len(res_logs.data)
-        return (count_menu + count_logs) > 0
+        # [新增] 已封存的舊紀錄也算有資料；封存表不存在時略過
+        count_archived = 0
+        try:
+            res_arch = run_query(supabase.table(ARCHIVE_TABLES['diet_logs']).select("id", count='exact').eq('pet_id', pet_id))
+            count_archived = res_arch.count if res_arch.count is not None else len(res_arch.data)
+        except Exception as e: logger.warning("讀取封存紀錄失敗: %s", e)
+        return (count_menu + count_logs + count_archived) > 0
     except: return False
 
 def soft_delete_pet(pet_id, reason):
     try:
-        supabase.table('pets').update({"is_deleted": True, "deletion_reason": reason}).eq('id', pet_id).execute()
+        run_query(supabase.table('pets').update({"is_deleted": True, "deletion_reason": reason}).eq('id', pet_id), idempotent=False)
         st.cache_data.clear()
         return True
     except: return False
 
 def hard_delete_pet(pet_id):
     try:
-        supabase.table('pets').delete().eq('id', pet_id).execute()
+        run_query(supabase.table('pets').delete().eq('id', pet_id), idempotent=False)
         st.cache_data.clear()
         return True
     except: return False
@@ -142,17 +314,17 @@ def calculate_age(birth_date_str):
 def add_new_food_to_library_and_menu(food_data, pet_id):
     try:
         # 新增食物到 Global Library
-        res = supabase.table('food_library').insert(food_data).execute()
+        res = run_query(supabase.table('food_library').insert(food_data), idempotent=False)
         if res.data:
             new_food_id = res.data[0]['id']
             # 加入自己的點餐本
-            supabase.table('pet_food_relations').insert({"pet_id": pet_id, "food_id": new_food_id}).execute()
+            run_query(supabase.table('pet_food_relations').insert({"pet_id": pet_id, "food_id": new_food_id}), idempotent=False)
             return True
     except: return False
 
 def fetch_pet_menu(pet_id):
     try:
-        response = supabase.table('pet_food_relations').select("food_id, food_library(id, name, brand, category, calories_100g, unit_type, protein_pct, fat_pct, phos_pct, fiber_pct, ash_pct, moisture_pct)").eq("pet_id", pet_id).eq("is_active", True).execute()
+        response = run_query(supabase.table('pet_food_relations').select("food_id, food_library(id, name, brand, category, calories_100g, unit_type, protein_pct, fat_pct, phos_pct, fiber_pct, ash_pct, moisture_pct)").eq("pet_id", pet_id).eq("is_active", True))
         data = []
         for item in response.data:
             if item['food_library']:
@@ -162,17 +334,81 @@ def fetch_pet_menu(pet_id):
         return pd.DataFrame(data)
     except: return pd.DataFrame()
 
+# ------------------------------------------
+# [新增] 點餐本搜尋索引 (品牌 + 品名，字元 n-gram 支援中文)
+# ------------------------------------------
+MENU_SEARCH_TOP_K = 20
+
+def get_menu_key(df_menu):
+    # 點餐本內容不變時 key 相同，索引只建一次
+    return tuple(zip(df_menu['relation_food_id'], df_menu['category'], df_menu['brand'].fillna(""), df_menu['name'].fillna("")))
+
+def _char_ngrams(text, n):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+@st.cache_resource(max_entries=64)
+def build_menu_index(menu_key):
+    labels = []
+    texts = []
+    grams = {}
+    for i, (_, cat, brand, name) in enumerate(menu_key):
+        labels.append(f"[{CATEGORY_MAP.get(cat, cat)}] {brand} - {name}")
+        text = f"{brand} {name}".strip().lower()
+        texts.append(text)
+        for g in _char_ngrams(text, 1) | _char_ngrams(text, 2):
+            grams.setdefault(g, set()).add(i)
+    return {"labels": labels, "texts": texts, "ids": [k[0] for k in menu_key], "names": [k[3] for k in menu_key], "grams": grams}
+
+def search_menu_index(index, query, usage, meal_name, k=MENU_SEARCH_TOP_K):
+    terms = query.lower().split()
+    candidates = None
+    for term in terms:
+        n = 2 if len(term) >= 2 else 1
+        for g in _char_ngrams(term, n):
+            hits = index["grams"].get(g, set())
+            candidates = hits if candidates is None else candidates & hits
+    if candidates is None: candidates = range(len(index["texts"]))
+    # n-gram 只是候選，需確認完整字串有出現
+    matched = [i for i in candidates if all(t in index["texts"][i] for t in terms)]
+    # 未輸入關鍵字時回傳整本點餐本 (依使用次數排序)，選單本身仍可即時篩選
+    if not terms: k = None
+
+    meal_usage = usage["by_meal"].get(meal_name, {})
+    def count(counts, i):
+        # 有 food_id 的紀錄精準對應；舊紀錄只有品名，同名食物共用次數
+        return counts.get(("id", index["ids"][i]), 0) + counts.get(("name", index["names"][i]), 0)
+    def rank(i):
+        name = index["names"][i]
+        is_prefix = any(index["texts"][i].startswith(t) or name.lower().startswith(t) for t in terms)
+        return (-count(meal_usage, i), -count(usage["total"], i), not is_prefix, i)
+    return sorted(matched, key=rank)[:k]
+
+@st.cache_data(ttl=600)
+def fetch_recent_food_usage(pet_id, limit=300):
+    usage = {"by_meal": {}, "total": {}}
+    try:
+        res = run_query(supabase.table('diet_logs').select("food_id, food_name, meal_name")\
+            .eq('pet_id', pet_id).eq('log_type', 'intake')\
+            .order('timestamp', desc=True).limit(limit))
+        for r in res.data:
+            key = ("id", r['food_id']) if r.get('food_id') is not None else ("name", r['food_name'])
+            meal = usage["by_meal"].setdefault(r['meal_name'], {})
+            meal[key] = meal.get(key, 0) + 1
+            usage["total"][key] = usage["total"].get(key, 0) + 1
+    except: pass
+    return usage
+
 # [新增] 取得使用者所有寵物的常用食物 ID 列表 (智慧點餐本用)
 def get_user_common_food_ids(user_id):
     try:
         # 1. 找出該使用者所有的寵物 ID
-        pets_res = supabase.table('pets').select('id').eq('user_id', user_id).execute()
+        pets_res = run_query(supabase.table('pets').select('id').eq('user_id', user_id))
         pet_ids = [p['id'] for p in pets_res.data]
         
         if not pet_ids: return []
 
         # 2. 找出這些寵物有點過的所有 food_id
-        relations = supabase.table('pet_food_relations').select('food_id').in_('pet_id', pet_ids).execute()
+        relations = run_query(supabase.table('pet_food_relations').select('food_id').in_('pet_id', pet_ids))
         food_ids = list(set([r['food_id'] for r in relations.data])) # 去重
         return food_ids
     except:
@@ -183,27 +419,239 @@ def save_log_entry(entries):
         # 補上 user_id
         for e in entries:
             e['user_id'] = st.session_state.user_id
-        supabase.table('diet_logs').insert(entries).execute()
+        run_query(supabase.table('diet_logs').insert(entries), idempotent=False)
+        update_nutrient_windows(entries)
+        fetch_recent_food_usage.clear()
         return True
     except: return False
 
+# ------------------------------------------
+# [新增] 滾動視窗營養警示 (每隻寵物保留每日加總，存檔時增量更新)
+# ------------------------------------------
+def get_alert_rules():
+    rules = {tag: dict(limits) for tag, limits in ALERT_RULES.items()}
+    try:
+        for tag, limits in st.secrets.get("alerts", {}).items():
+            rules.setdefault(tag, {}).update(limits)
+    except: pass
+    # 只保留支援的營養素，設定錯字不應讓畫面崩潰
+    for tag, limits in rules.items():
+        for nutrient in [n for n in limits if n not in ALERT_NUTRIENTS]:
+            logger.warning("忽略未知的警示營養素 %s (%s)", nutrient, tag)
+            del limits[nutrient]
+    return rules
+
+@st.cache_resource
+def init_nutrient_store():
+    # days: {pet_id: {date_str: {"calories": x, "fat": y, "phos": z}}}，跨 session 共用
+    # inflight: {pet_id: {date_str: 讀取中的次數}}；dirty: 讀取期間有新紀錄寫入的日期
+    return {"lock": threading.Lock(), "days": {}, "seeded": {}, "seeded_at": {}, "inflight": {}, "dirty": {}}
+
+nutrient_store = init_nutrient_store()
+NUTRIENT_STORE_MAX_DAYS = 62
+# 超過此秒數重新從資料庫讀取，涵蓋其他機器或 save_log_entry 以外的異動
+NUTRIENT_STORE_TTL = 300
+
+def _add_to_bucket(buckets, date_str, entry):
+    bucket = buckets.setdefault(date_str, {k: 0.0 for k in ALERT_NUTRIENTS})
+    for k in ALERT_NUTRIENTS:
+        bucket[k] += float(entry.get(k) or 0)
+
+def update_nutrient_windows(entries):
+    with nutrient_store["lock"]:
+        for e in entries:
+            pet_id = e.get('pet_id'); date_str = e.get('date_str')
+            if date_str in nutrient_store["inflight"].get(pet_id, {}):
+                # 正在讀取的日期：快照可能不含此筆，讀取完成後不採用，下次重新讀取
+                nutrient_store["dirty"].setdefault(pet_id, set()).add(date_str)
+                continue
+            # 尚未載入的日期之後會一併從資料庫讀取，不需要在此累加
+            if date_str not in nutrient_store["seeded"].get(pet_id, set()): continue
+            _add_to_bucket(nutrient_store["days"][pet_id], date_str, e)
+
+def _seed_nutrient_days(pet_id, needed):
+    with nutrient_store["lock"]:
+        if time.time() - nutrient_store["seeded_at"].get(pet_id, 0) > NUTRIENT_STORE_TTL:
+            nutrient_store["days"].pop(pet_id, None)
+            nutrient_store["seeded"].pop(pet_id, None)
+            nutrient_store["seeded_at"][pet_id] = time.time()
+        seeded = nutrient_store["seeded"].get(pet_id, set())
+        missing = [d for d in needed if d not in seeded]
+        if not missing: return True
+        inflight = nutrient_store["inflight"].setdefault(pet_id, {})
+        for d in missing: inflight[d] = inflight.get(d, 0) + 1
+
+    try:
+        # 含早於封存期限的日期時一併讀取封存資料
+        df_seed = fetch_log_tiers(lambda q: q.select("id, date_str, calories, fat, phos")\
+            .eq('pet_id', pet_id).in_('date_str', missing).order('id'),
+            include_archive=is_archived_date(min(missing)))
+        seed_rows = df_seed.fillna(0).to_dict('records')
+    except Exception:
+        seed_rows = None
+
+    with nutrient_store["lock"]:
+        inflight = nutrient_store["inflight"][pet_id]
+        dirty = nutrient_store["dirty"].get(pet_id, set())
+        usable = [] if seed_rows is None else [d for d in missing if d not in dirty]
+        for d in missing:
+            inflight[d] -= 1
+            if inflight[d] == 0:
+                del inflight[d]
+                dirty.discard(d)
+        if seed_rows is None: raise RuntimeError("讀取營養紀錄失敗")
+
+        buckets = nutrient_store["days"].setdefault(pet_id, {})
+        seeded = nutrient_store["seeded"].setdefault(pet_id, set())
+        new_dates = set(d for d in usable if d not in seeded)
+        for d in new_dates:
+            buckets[d] = {k: 0.0 for k in ALERT_NUTRIENTS}
+        for row in seed_rows:
+            if row['date_str'] in new_dates:
+                _add_to_bucket(buckets, row['date_str'], row)
+        seeded.update(new_dates)
+        # 只保留最近的日期，避免長時間瀏覽歷史後無限成長
+        if len(buckets) > NUTRIENT_STORE_MAX_DAYS:
+            for d in sorted(buckets)[:len(buckets) - NUTRIENT_STORE_MAX_DAYS]:
+                del buckets[d]
+                seeded.discard(d)
+        return len(usable) == len(missing)
+
+def ensure_nutrient_days(pet_id, end_date):
+    needed = [str(end_date - timedelta(days=i)) for i in range(max(ALERT_WINDOWS))]
+    # 讀取期間有新紀錄寫入的日期會被捨棄，再讀一次
+    for _ in range(3):
+        if _seed_nutrient_days(pet_id, needed): return
+    # 仍有日期未載入時不能以部分加總比對上限，交由呼叫端略過警示
+    raise RuntimeError("營養紀錄載入未完成")
+
+def get_nutrient_alerts(pet_data, end_date):
+    tags = pet_data.get('health_tags') or []
+    rules = get_alert_rules()
+    active = {tag: rules[tag] for tag in tags if tag in rules}
+    weight = float(pet_data.get('weight') or 0)
+    if not active or weight <= 0: return []
+
+    try: ensure_nutrient_days(pet_data['id'], end_date)
+    except: return []
+
+    with nutrient_store["lock"]:
+        buckets = nutrient_store["days"].get(pet_data['id'], {})
+        daily = [buckets.get(str(end_date - timedelta(days=i)), {}) for i in range(max(ALERT_WINDOWS))]
+
+    alerts = []
+    for days in ALERT_WINDOWS:
+        for tag, limits in active.items():
+            for nutrient, per_kg in limits.items():
+                scale = ALERT_NUTRIENTS[nutrient][2]
+                total = sum(b.get(nutrient, 0.0) for b in daily[:days]) * scale
+                budget = per_kg * weight * days
+                if total > budget:
+                    alerts.append({"tag": tag, "nutrient": nutrient, "days": days, "total": total, "budget": budget})
+    return alerts
+
 def fetch_daily_logs(pet_id, date_str):
     try:
         start = f"{date_str} 00:00:00"
         end = f"{date_str} 23:59:59"
-        resp = supabase.table('diet_logs').select("*").eq('pet_id', pet_id).gte('timestamp', start).lte('timestamp', end).order('timestamp').execute()
-        return pd.DataFrame(resp.data)
+        # [修改] 早於封存期限的日期一併讀取封存資料
+        df = fetch_log_tiers(
+            lambda q: q.select("*").eq('pet_id', pet_id).gte('timestamp', start).lte('timestamp', end).order('timestamp').order('id'),
+            include_archive=is_archived_date(date_str))
+        if df.empty: return df
+        return df.sort_values('timestamp').reset_index(drop=True)
     except: return pd.DataFrame()
 
+def fetch_paged(build_query, page_size=1000):
+    # Supabase 單次回傳筆數有上限，大量資料需分頁讀取 (查詢需含唯一排序鍵，如 id)
+    rows = []
+    offset = 0
+    while True:
+        resp = run_query(build_query().range(offset, offset + page_size - 1))
+        rows.extend(resp.data)
+        if len(resp.data) < page_size: break
+        offset += page_size
+    return rows
+
+def is_archived_date(date_str):
+    return str(date_str) < str(get_archive_cutoff())
+
+def fetch_log_tiers(apply_query, include_archive=True, page_size=1000):
+    # 熱資料失敗照常拋出；封存層獨立處理，封存表不存在或無法連線時仍保留熱資料
+    rows = fetch_paged(lambda: apply_query(supabase.table('diet_logs')), page_size)
+    if include_archive:
+        try: rows.extend(fetch_paged(lambda: apply_query(supabase.table(ARCHIVE_TABLES['diet_logs'])), page_size))
+        except Exception as e: logger.warning("讀取封存紀錄失敗: %s", e)
+    df = pd.DataFrame(rows)
+    if df.empty: return df
+    # 搬移途中兩層可能同時存在同一筆，以 id 去重
+    return df.drop(columns=['archived_at'], errors='ignore').drop_duplicates(subset='id')
+
 def fetch_all_logs_for_export(pet_id):
     try:
-        resp = supabase.table('diet_logs').select("*").eq('pet_id', pet_id).order('timestamp', desc=True).execute()
-        return pd.DataFrame(resp.data)
+        # [修改] 同時讀取熱資料與封存資料
+        df = fetch_log_tiers(lambda q: q.select("*").eq('pet_id', pet_id).order('timestamp', desc=True).order('id'))
+        if df.empty: return df
+        return df.sort_values('timestamp', ascending=False).reset_index(drop=True)
     except: return pd.DataFrame()
     
+# [新增] 全家總覽：以 in_ 一次抓取多隻寵物在日期區間內的紀錄 (取代逐隻查詢)
+def fetch_household_logs(pet_ids, start_date_str, end_date_str, page_size=1000):
+    if not pet_ids: return pd.DataFrame()
+    try:
+        start = f"{start_date_str} 00:00:00"
+        end = f"{end_date_str} 23:59:59"
+        # 區間早於封存期限時，一併讀取封存資料；timestamp 只到秒，以 id 作為分頁排序的唯一鍵
+        return fetch_log_tiers(
+            lambda q: q.select("id, pet_id, date_str, food_name, net_weight, calories, protein, fat, phos")\
+                .in_('pet_id', pet_ids)\
+                .gte('timestamp', start).lte('timestamp', end)\
+                .order('timestamp').order('id'),
+            include_archive=is_archived_date(start_date_str), page_size=page_size)
+    except: return pd.DataFrame()
+
+def fetch_food_library_stats_info():
+    try:
+        lib_res = run_query(supabase.table('food_library').select("name, category, moisture_pct"))
+        return pd.DataFrame(lib_res.data)
+    except: return pd.DataFrame()
+
+# [新增] 單次 groupby 算出每隻寵物的統計 (計算方式同 Tab 1 今日營養統計)
+def summarize_logs_by_pet(df_logs, df_lib):
+    stat_cols = ['net_cal', 'input', 'eaten', 'water', 'prot', 'fat', 'phos', 'days']
+    if df_logs.empty: return pd.DataFrame(columns=stat_cols)
+
+    if df_lib.empty: df_lib = pd.DataFrame(columns=['name', 'category', 'moisture_pct'])
+    # 同名食物只取一筆，避免 merge 後紀錄被重複計算
+    df_lib = df_lib.drop_duplicates(subset='name')
+    df = pd.merge(df_logs, df_lib, left_on='food_name', right_on='name', how='left')
+
+    for c in ['net_weight', 'calories', 'protein', 'fat', 'phos', 'moisture_pct']:
+        if c not in df.columns: df[c] = 0.0
+        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
+
+    exclude_pets = ['med', 'supp']
+    mask_is_food = ~df['category'].fillna('other').isin(exclude_pets)
+    mask_positive = df['net_weight'] > 0
+
+    df['calc_water'] = df['net_weight'] * (df['moisture_pct'] / 100)
+    df['food_input'] = df['net_weight'].where(mask_is_food & mask_positive, 0.0)
+    df['food_eaten'] = df['net_weight'].where(mask_is_food, 0.0)
+
+    return df.groupby('pet_id').agg(
+        net_cal=('calories', 'sum'),
+        input=('food_input', 'sum'),
+        eaten=('food_eaten', 'sum'),
+        water=('calc_water', 'sum'),
+        prot=('protein', 'sum'),
+        fat=('fat', 'sum'),
+        phos=('phos', 'sum'),
+        days=('date_str', 'nunique'),
+    )
+
 def get_last_meal_density(pet_id):
     try:
-        logs_res = supabase.table('diet_logs').select("*").eq('pet_id', pet_id).eq('log_type', 'intake').order('timestamp', desc=True).limit(50).execute()
+        logs_res = run_query(supabase.table('diet_logs').select("*").eq('pet_id', pet_id).eq('log_type', 'intake').order('timestamp', desc=True).limit(50))
         logs = logs_res.data
         if not logs: return None
 
@@ -218,7 +666,7 @@ def get_last_meal_density(pet_id):
         
         this_meal_logs = [l for l in logs if l['meal_name'] == target_meal and l['date_str'] == target_date]
         food_names = [l['food_name'] for l in this_meal_logs]
-        lib_res = supabase.table('food_library').select('name, category').in_('name', food_names).execute()
+        lib_res = run_query(supabase.table('food_library').select('name, category').in_('name', food_names))
         food_cat_map = {item['name']: item['category'] for item in lib_res.data}
 
         total_weight = 0.0; total_cal = 0.0; total_prot = 0.0; total_fat = 0.0; total_phos = 0.0
@@ -241,6 +689,110 @@ def get_last_meal_density(pet_id):
         }
     except: return None
 
+# ------------------------------------------
+# [新增] 資料分層封存
+# 封存表結構與原表相同，另加 archived_at 欄位 (以 id 為主鍵)，建立方式見 sql/001_archive_tables.sql：
+#   pets_archive / diet_logs_archive / pet_food_relations_archive
+# ------------------------------------------
+ARCHIVE_TABLES = {
+    "pets": "pets_archive",
+    "diet_logs": "diet_logs_archive",
+    "pet_food_relations": "pet_food_relations_archive",
+}
+# 可在 secrets.toml 的 [archive] 區塊覆寫
+ARCHIVE_DEFAULTS = {
+    "log_horizon_days": 365,   # 超過此天數的紀錄移到封存表
+    "batch_size": 500,
+    "run_interval_hours": 24,  # 每位使用者最多多久執行一次
+}
+
+def get_archive_config():
+    cfg = dict(ARCHIVE_DEFAULTS)
+    try: cfg.update(st.secrets.get("archive", {}))
+    except: pass
+    return cfg
+
+ARCHIVE_CONFIG = get_archive_config()
+
+def get_archive_cutoff():
+    return date.today() - timedelta(days=int(ARCHIVE_CONFIG["log_horizon_days"]))
+
+def move_rows_to_archive(table, apply_filter):
+    # 先 upsert 到封存表再刪除原資料；中途失敗重跑也不會重複
+    batch_size = int(ARCHIVE_CONFIG["batch_size"])
+    archived_at = datetime.now().isoformat()
+    moved = 0
+    while True:
+        res = run_query(apply_filter(supabase.table(table).select("*")).limit(batch_size))
+        rows = res.data
+        if not rows: break
+        for r in rows: r['archived_at'] = archived_at
+        run_query(supabase.table(ARCHIVE_TABLES[table]).upsert(rows), idempotent=False)
+        del_res = run_query(supabase.table(table).delete().in_('id', [r['id'] for r in rows]), idempotent=False)
+        # 刪除筆數不足 (如 RLS 擋下) 時中止，否則下一輪會一直讀到同一批資料
+        if len(del_res.data or []) < len(rows):
+            raise RuntimeError(f"{table} 只刪除 {len(del_res.data or [])}/{len(rows)} 筆，請確認刪除權限")
+        moved += len(rows)
+        if len(rows) < batch_size: break
+    return moved
+
+def archive_pet(pet_id):
+    moved = move_rows_to_archive('diet_logs', lambda q: q.eq('pet_id', pet_id))
+    moved += move_rows_to_archive('pet_food_relations', lambda q: q.eq('pet_id', pet_id))
+    move_rows_to_archive('pets', lambda q: q.eq('id', pet_id))
+    return moved
+
+def run_archival_job(user_id):
+    result = {"pets": 0, "logs": 0}
+    pets_res = run_query(supabase.table('pets').select('id, is_deleted').eq('user_id', user_id))
+
+    # 1. 已封存 (註記刪除) 的寵物：整隻連同紀錄移到封存表
+    for p in pets_res.data:
+        if p.get('is_deleted'):
+            archive_pet(p['id'])
+            result["pets"] += 1
+
+    # 2. 仍在使用的寵物：超過期限的紀錄移到封存表
+    active_ids = [p['id'] for p in pets_res.data if not p.get('is_deleted')]
+    if active_ids:
+        cutoff = f"{get_archive_cutoff()} 00:00:00"
+        result["logs"] = move_rows_to_archive('diet_logs', lambda q: q.in_('pet_id', active_ids).lt('timestamp', cutoff))
+
+    if result["pets"]: st.cache_data.clear()
+    return result
+
+@st.cache_resource
+def init_archive_state():
+    return {"lock": threading.Lock(), "last_run": {}, "running": set(), "last_result": {}}
+
+def _archival_worker(user_id, state):
+    try:
+        result = run_archival_job(user_id)
+        logger.info("封存完成 user=%s pets=%s logs=%s", user_id, result["pets"], result["logs"])
+        summary = {"ok": True, "time": datetime.now().strftime('%Y-%m-%d %H:%M'), **result}
+    except Exception as e:
+        logger.exception("封存失敗 user=%s", user_id)
+        summary = {"ok": False, "time": datetime.now().strftime('%Y-%m-%d %H:%M'), "error": str(e)}
+    with state["lock"]:
+        state["running"].discard(user_id)
+        state["last_result"][user_id] = summary
+
+def maybe_run_archival(user_id):
+    # 在背景執行緒搬移資料，不阻塞畫面渲染
+    state = init_archive_state()
+    now = time.time()
+    with state["lock"]:
+        if user_id in state["running"]: return
+        if now - state["last_run"].get(user_id, 0) < ARCHIVE_CONFIG["run_interval_hours"] * 3600: return
+        state["last_run"][user_id] = now
+        state["running"].add(user_id)
+    threading.Thread(target=_archival_worker, args=(user_id, state), daemon=True).start()
+
+def get_archival_status(user_id):
+    state = init_archive_state()
+    with state["lock"]:
+        return user_id in state["running"], state["last_result"].get(user_id)
+
 # ==========================================
 # 4. 畫面渲染函式 (UI Components)
 # ==========================================
@@ -267,6 +819,47 @@ def login_page():
                 else:
                     st.error("請輸入名稱")
 
+# [新增] 全家總覽：所有寵物在同一區間的統計並排比較
+def render_household_overview(df_pets):
+    st.markdown("### 🏠 全家總覽")
+
+    df_valid = df_pets[df_pets['name'].fillna('').str.strip() != '']
+    if df_valid.empty: return
+
+    today = date.today()
+    date_range = st.date_input("統計區間", (today - timedelta(days=6), today), key="household_range")
+    if not isinstance(date_range, (list, tuple)) or len(date_range) != 2:
+        st.info("請選擇起訖日期")
+        return
+    start_d, end_d = date_range
+    num_days = (end_d - start_d).days + 1
+
+    with st.spinner("讀取中..."):
+        df_logs = fetch_household_logs(df_valid['id'].tolist(), str(start_d), str(end_d))
+        df_lib = fetch_food_library_stats_info() if not df_logs.empty else pd.DataFrame()
+
+    stats = summarize_logs_by_pet(df_logs, df_lib)
+    # 沒有紀錄的寵物也要列出 (數值為 0)
+    stats = stats.reindex(df_valid['id'].tolist()).fillna(0)
+
+    df_show = pd.DataFrame({
+        '寵物': df_valid['name'].tolist(),
+        '淨熱量 (kcal)': stats['net_cal'].values,
+        '日均熱量 (kcal)': stats['net_cal'].values / num_days,
+        '投入量 (g)': stats['input'].values,
+        '食用量 (g)': stats['eaten'].values,
+        '總水量 (ml)': stats['water'].values,
+        '總蛋白 (g)': stats['prot'].values,
+        '總脂肪 (g)': stats['fat'].values,
+        '磷總量 (mg)': stats['phos'].values * ALERT_NUTRIENTS['phos'][2],
+        '紀錄天數': stats['days'].astype(int).values,
+    })
+
+    st.caption(f"📅 {start_d} ~ {end_d}，共 {num_days} 天")
+    st.dataframe(df_show.round(1), use_container_width=True, hide_index=True)
+    if df_show['淨熱量 (kcal)'].abs().sum() > 0:
+        st.bar_chart(df_show.set_index('寵物')['日均熱量 (kcal)'])
+
 @st.dialog("📷 更換大頭照")
 def open_crop_dialog(pet_id):
     st.write("請上傳圖片並選取範圍：")
@@ -290,7 +883,7 @@ def open_crop_dialog(pet_id):
         st.divider()
         if st.button("確認使用這張照片", type="primary", use_container_width=True):
             base64_str = pil_image_to_base64(cropped_img)
-            supabase.table('pets').update({"image_data": base64_str}).eq('id', pet_id).execute()
+            run_query(supabase.table('pets').update({"image_data": base64_str}).eq('id', pet_id), idempotent=False)
             st.toast("✅ 照片已更新！")
             st.cache_data.clear()
             time.sleep(1)
@@ -443,16 +1036,31 @@ def render_sidebar():
                         time.sleep(1)
                         st.rerun()
     
-    # 回傳目前選擇的寵物資料 (如果是 '請選擇' 或 '新增' 則回傳 None 或空字典)
+    # [新增] 連線監控 (共用連線池 / 重試 / 斷路器)
+    with st.sidebar.expander("🔧 連線狀態", expanded=False):
+        stats = get_http_stats()
+        if stats["breaker_open"]: st.error("斷路器開啟中，暫停查詢")
+        if "pool_total" in stats:
+            st.caption(f"連線池：使用中 {stats['pool_active']} / 閒置 {stats['pool_idle']} / 上限 {stats['max_connections']}")
+        st.caption(f"請求 {stats['requests']}・執行中 {stats['in_flight']}・重試 {stats['retries']}・錯誤 {stats['errors']}・拒絕 {stats['rejected']}")
+
+        # [新增] 資料封存狀態
+        archiving, last = get_archival_status(st.session_state.user_id)
+        if archiving: st.caption("🗄️ 資料封存執行中...")
+        elif last and last["ok"]: st.caption(f"🗄️ 上次封存 {last['time']}：寵物 {last['pets']}・紀錄 {last['logs']}")
+        elif last: st.warning(f"🗄️ 上次封存失敗 ({last['time']})：{last['error']}")
+
+    # 回傳目前選擇的寵物資料 (如果是 '請選擇' 或 '新增' 則為 None)，以及寵物清單供首頁總覽沿用
     if is_valid_pet:
-        return current_pet_data
-    return None
+        return current_pet_data, df_pets
+    return None, df_pets
 
 # ==========================================
 # 5. 主程式邏輯 (Main)
 # ==========================================
 def main_app():
-    current_pet = render_sidebar()
+    maybe_run_archival(st.session_state.user_id)
+    current_pet, df_pets = render_sidebar()
 
     if not current_pet:
         st.info("👈 請先在側邊欄選擇或新增寵物")
@@ -468,6 +1076,11 @@ def main_app():
         st.write("---")
         st.markdown(f"### 👋 Hi, {st.session_state.user_id}")
         st.write("請從左側選單選擇一位主子，或是點擊「➕ 新增寵物」來建立新資料。")
+
+        # 沿用側邊欄已讀取的寵物清單，不重複查詢
+        if not df_pets.empty:
+            st.write("---")
+            render_household_overview(df_pets)
         st.stop()
     
     pet_id = current_pet['id']
@@ -505,7 +1118,7 @@ def main_app():
 
         if not df_logs.empty:
             try:
-                lib_res = supabase.table('food_library').select("name, category, moisture_pct").execute()
+                lib_res = run_query(supabase.table('food_library').select("name, category, moisture_pct"))
                 df_lib = pd.DataFrame(lib_res.data)
 
                 df_merged = pd.merge(df_logs, df_lib, left_on='food_name', right_on='name', how='left')
@@ -513,7 +1126,8 @@ def main_app():
                 today_net_cal = df_merged['calories'].sum()
                 today_prot = df_merged['protein'].sum()
                 today_fat = df_merged['fat'].sum()
-                if 'phos' in df_merged.columns: today_phos = df_merged['phos'].sum()
+                # diet_logs.phos 以 g 儲存，換算成 mg 與警示一致
+                if 'phos' in df_merged.columns: today_phos = df_merged['phos'].sum() * ALERT_NUTRIENTS['phos'][2]
 
                 df_merged['calc_water'] = df_merged['net_weight'] * (df_merged['moisture_pct'].fillna(0)/100)
                 today_water = df_merged['calc_water'].sum()
@@ -540,6 +1154,10 @@ def main_app():
         cols[5].metric("總脂肪", fmt(today_fat, "g"))
         cols[6].metric("磷總量", fmt(today_phos, "mg"))
 
+        for a in get_nutrient_alerts(current_pet, today_date):
+            name, unit, _ = ALERT_NUTRIENTS[a['nutrient']]
+            st.warning(f"⚠️ {a['tag']}：近 {a['days']} 日{name} {a['total']:.1f} {unit}，超過建議上限 {a['budget']:.1f} {unit}")
+
         st.divider()
 
         st.subheader("➕ 新增飲食 / 紀錄剩食")
@@ -555,15 +1173,18 @@ def main_app():
                     c_meal, c_food, c_weight = st.columns([1,2,1])
                     meal_time = c_meal.selectbox("餐別", ["第一餐","第二餐","第三餐","第四餐","第五餐","第六餐","第七餐","第八餐","第九餐","第十餐"])
                     
-                    menu_option = []
-                    for _, row in df_menu.iterrows():
-                        cat = CATEGORY_MAP.get(row['category'], row['category'])
-                        brand = row['brand'] or ""
-                        label = f"[{cat}] {brand} - {row['name']}"
-                        menu_option.append({"label": label, "data":row})
-                    
-                    sel_opt = c_food.selectbox("選擇食物", menu_option, format_func=lambda x:x['label'])
-                    f_data = sel_opt['data']
+                    # [修改] 以預建索引搜尋，依此寵物在該餐別的近期使用次數排序
+                    menu_index = build_menu_index(get_menu_key(df_menu))
+                    query = c_food.text_input("搜尋食物", placeholder="輸入品牌或品名", key=f"food_search_{pet_id}")
+                    matches = search_menu_index(menu_index, query, fetch_recent_food_usage(pet_id), meal_time)
+                    if query.strip() and not matches:
+                        c_food.caption("找不到符合的食物，顯示完整點餐本")
+                        matches = search_menu_index(menu_index, "", fetch_recent_food_usage(pet_id), meal_time)
+
+                    sel_idx = c_food.selectbox("選擇食物", matches, format_func=lambda i: menu_index['labels'][i])
+                    f_data = df_menu.iloc[sel_idx]
+                    food_id = f_data['relation_food_id']
+                    if hasattr(food_id, 'item'): food_id = food_id.item()
 
                     unit = f_data.get('unit_type','g')
                     weight = c_weight.number_input(f"份量 ({unit})", min_value=0.0, step=1.0)
@@ -580,6 +1201,7 @@ def main_app():
                                 "meal_name": meal_time,
                                 "pet_id": pet_id,
                                 "food_name": f_data['name'],
+                                "food_id": food_id,
                                 "net_weight": weight,
                                 "calories": cal_100g * ratio,
                                 "protein": float(f_data.get('protein_pct', 0)) * ratio,
@@ -682,13 +1304,13 @@ def main_app():
         
         st.markdown("#### 2. 編輯點餐本")
         try:
-            res_all = supabase.table('food_library').select("*").execute()
+            res_all = run_query(supabase.table('food_library').select("*"))
             df_all = pd.DataFrame(res_all.data)
         except: df_all = pd.DataFrame()
 
         if not df_all.empty:
             try:
-                res_my = supabase.table('pet_food_relations').select("food_id").eq("pet_id", pet_id).execute()
+                res_my = run_query(supabase.table('pet_food_relations').select("food_id").eq("pet_id", pet_id))
                 my_ids = [x['food_id'] for x in res_my.data]
             except: my_ids = []
 
@@ -735,10 +1357,10 @@ def main_app():
                 to_del = set(my_ids).intersection(all_ids) - set(cur_sel)
                 
                 if to_add:
-                    supabase.table('pet_food_relations').insert([{"pet_id": pet_id, "food_id": i} for i in to_add]).execute()
+                    run_query(supabase.table('pet_food_relations').insert([{"pet_id": pet_id, "food_id": i} for i in to_add]), idempotent=False)
                 if to_del:
                     for i in to_del:
-                        supabase.table('pet_food_relations').delete().eq('pet_id', pet_id).eq('food_id', i).execute()
+                        run_query(supabase.table('pet_food_relations').delete().eq('pet_id', pet_id).eq('food_id', i), idempotent=False)
                 st.toast("已更新"); time.sleep(1); st.rerun()
 
     # --- Tab 3: 匯出 ---
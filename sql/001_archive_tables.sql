@@ -0,0 +1,50 @@
+-- 資料分層封存用的封存表 (app.py: ARCHIVE_TABLES / run_archival_job)
+-- 結構與原表相同 (含主鍵 id)，另加 archived_at 欄位；不複製外鍵，寵物刪除後紀錄仍可保留
+-- 於 Supabase SQL Editor 執行一次即可 (可重複執行)
+
+create table if not exists pets_archive (like pets including all);
+alter table pets_archive add column if not exists archived_at timestamptz;
+
+create table if not exists diet_logs_archive (like diet_logs including all);
+alter table diet_logs_archive add column if not exists archived_at timestamptz;
+
+create table if not exists pet_food_relations_archive (like pet_food_relations including all);
+alter table pet_food_relations_archive add column if not exists archived_at timestamptz;
+
+-- 匯出 / 趨勢讀取路徑：依寵物與時間查詢
+create index if not exists diet_logs_archive_pet_ts_idx on diet_logs_archive (pet_id, "timestamp");
+create index if not exists diet_logs_archive_pet_date_idx on diet_logs_archive (pet_id, date_str);
+
+-- 權限：LIKE ... INCLUDING ALL 不會複製 RLS，一律開啟 RLS 並照抄原表的 policy
+-- 原表若沒有 policy，封存表即無法存取 (封存工作會失敗並顯示在側邊欄)，不會放寬權限
+alter table pets_archive enable row level security;
+alter table diet_logs_archive enable row level security;
+alter table pet_food_relations_archive enable row level security;
+
+do $$
+declare
+    pair record;
+    pol record;
+begin
+    for pair in
+        select * from (values
+            ('pets', 'pets_archive'),
+            ('diet_logs', 'diet_logs_archive'),
+            ('pet_food_relations', 'pet_food_relations_archive')
+        ) as t(hot, archive)
+    loop
+        for pol in
+            select * from pg_policies
+            where schemaname = 'public' and tablename = pair.hot
+        loop
+            execute format('drop policy if exists %I on public.%I', pol.policyname, pair.archive);
+            execute format(
+                'create policy %I on public.%I as %s for %s to %s%s%s',
+                pol.policyname, pair.archive, pol.permissive, pol.cmd,
+                (select string_agg(quote_ident(r), ', ') from unnest(pol.roles) as r),
+                case when pol.qual is not null then ' using (' || pol.qual || ')' else '' end,
+                case when pol.with_check is not null then ' with check (' || pol.with_check || ')' else '' end
+            );
+        end loop;
+    end loop;
+end $$;
@@ -0,0 +1,20 @@
+-- diet_logs 記錄食物 id，點餐本依使用次數排序時可區分同名不同品牌的食物
+-- 型別與 food_library.id 相同；舊紀錄維持 null，排序時改以品名對應
+-- 於 Supabase SQL Editor 執行一次即可 (可重複執行)；須在啟用新版 app 前執行
+
+do $$
+declare
+    id_type text;
+begin
+    select format_type(atttypid, atttypmod) into id_type
+    from pg_attribute
+    where attrelid = 'public.food_library'::regclass and attname = 'id';
+
+    execute format('alter table public.diet_logs add column if not exists food_id %s', id_type);
+    -- 封存表需與原表欄位一致
+    if to_regclass('public.diet_logs_archive') is not null then
+        execute format('alter table public.diet_logs_archive add column if not exists food_id %s', id_type);
+    end if;
+end $$;
+
+create index if not exists diet_logs_pet_food_idx on diet_logs (pet_id, food_id);